@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline Rule Replay - Evaluate shift light / AFR rules against SD card logs
+
+Replays archived LOGxxxx.csv sessions written by sd_logger.cpp and evaluates
+threshold + hysteresis rules (the firmware shift light, example AFR lean/rich
+rules and user-defined rules) over a grid of parameter settings. Reports activation
+counts, active durations and lead times for every setting, so thresholds can be
+tuned without flashing and driving.
+
+Each session is parsed once into per-signal column arrays. All thresholds of a
+sweep are located in a single pass per signal (crossing edges for every grid
+level at once), and each setting is then evaluated by walking only those
+crossings instead of running a per-sample state machine. Sessions are spread
+across CPU cores with a process pool.
+
+Usage:
+    python log_rule_replay.py LOGS_DIR [LOGS_DIR|LOG0001.csv ...]
+        [--rules rules.json] [--only shift_light,afr_lean]
+        [--set shift_light.on=3500:6000:250] [--jobs N] [--csv report.csv]
+
+Rule file format (JSON list, or {"rules": [...]}):
+    {
+      "name": "oil_temp_high",
+      "signal": "RPM" | "AFR" | "LAMBDA" | "TPS" | 1699696209 | [5130001, 1699696209],
+      "direction": "above" | "below",
+      "on": 4000 | [3500, 4000, 4500] | "3500:6000:250",
+      "off": 3800 | [...]          (optional, defaults to "on" - no hysteresis)
+      "target": 6500 | [...]       (optional, level used for lead time)
+      "scale": 1.0                 (optional, multiplier applied to the signal)
+    }
+List / range values of on, off and target are swept as a cartesian grid.
+"""
+
+import sys
+import csv
+import math
+import json
+import argparse
+import itertools
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+# Fix Windows console encoding
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+
+# Firmware constants (epic_can_logger.ino / sd_logger.h)
+SHIFT_LIGHT_RPM_THRESHOLD = 4000
+VAR_ID_TPS_VALUE = 1272048601
+VAR_ID_RPM_VALUE = 1699696209
+VAR_ID_AFR_VALUE = -1093429509
+LAMBDA_TO_AFR = 14.7
+LOG_FILE_PATTERN = 'LOG*.csv'
+
+
+def dbc_sig_id(msg_id, sig_offset):
+    """Mirror of the DBC_SIG_ID() macro used when logging DBC signals"""
+    return msg_id * 10000 + sig_offset
+
+
+def log_var_id(var_id):
+    """VarID as written to the log (sd_logger prints var_id as unsigned 32-bit)"""
+    return var_id & 0xFFFFFFFF
+
+
+# Valid raw ranges the firmware checks before using a DBC signal (it logs the
+# signal unconditionally, so out-of-range samples are present in the logs)
+DBC_RPM_MAX = 20000         # epic_can_logger.ino: dbc_base1.RPM <= 20000
+DBC_LAMBDA_MIN = 0.5        # epic_can_logger.ino: 0.5 <= dbc_base7.Lam1 <= 2.0
+DBC_LAMBDA_MAX = 2.0
+DBC_TPS_MIN = 0.0           # epic_can_logger.ino: 0 <= dbc_base2.TPS1 <= 100
+DBC_TPS_MAX = 100.0
+
+# Signal aliases: list of (logged VarID, scale, lo, hi) sources merged into one
+# series. Raw samples outside [lo, hi] (None = unbounded) are dropped before
+# scaling. RPM comes from EPIC RPMValue or DBC BASE1 (0x201); AFR from EPIC
+# AFRValue or DBC BASE7 (0x207) Lam1, converted to AFR only when the firmware
+# would accept it.
+SIGNALS = {
+    'RPM': [(log_var_id(VAR_ID_RPM_VALUE), 1.0, None, None),
+            (dbc_sig_id(513, 1), 1.0, None, DBC_RPM_MAX)],
+    'AFR': [(log_var_id(VAR_ID_AFR_VALUE), 1.0, None, None),
+            (dbc_sig_id(519, 1), LAMBDA_TO_AFR, DBC_LAMBDA_MIN, DBC_LAMBDA_MAX)],
+    'LAMBDA': [(dbc_sig_id(519, 1), 1.0, DBC_LAMBDA_MIN, DBC_LAMBDA_MAX)],
+    'TPS': [(VAR_ID_TPS_VALUE, 1.0, None, None),
+            (dbc_sig_id(514, 1), 1.0, DBC_TPS_MIN, DBC_TPS_MAX)],
+}
+
+# Built-in rules. shift_light mirrors the firmware (RPM >= SHIFT_LIGHT_RPM_THRESHOLD);
+# the firmware has no AFR thresholds (it only stores afrValue), so the afr_lean /
+# afr_rich levels are example defaults meant to be overridden with --set or --rules
+DEFAULT_RULES = [
+    {
+        'name': 'shift_light',
+        'signal': 'RPM',
+        'direction': 'above',
+        'on': [SHIFT_LIGHT_RPM_THRESHOLD],
+        'target': [6500],
+    },
+    {
+        'name': 'afr_lean',
+        'signal': 'AFR',
+        'direction': 'above',
+        'on': [15.5],
+        'off': [15.0],
+        'target': [16.5],
+    },
+    {
+        'name': 'afr_rich',
+        'signal': 'AFR',
+        'direction': 'below',
+        'on': [11.0],
+        'off': [11.5],
+        'target': [10.0],
+    },
+]
+
+
+def parse_values(spec):
+    """Parse a rule parameter into a list of floats.
+
+    Accepts a number, a list of numbers, "a,b,c" or an inclusive "start:stop:step" range.
+    """
+    if spec is None:
+        return [None]
+    if isinstance(spec, (int, float)):
+        return [float(spec)]
+    if isinstance(spec, list):
+        return [float(v) for v in spec]
+    text = str(spec).strip()
+    if ':' in text:
+        parts = [float(p) for p in text.split(':')]
+        if len(parts) != 3 or parts[2] <= 0:
+            raise ValueError(f"Invalid range '{text}' (expected start:stop:step)")
+        start, stop, step = parts
+        if stop < start:
+            raise ValueError(f"Invalid range '{text}' (stop is below start)")
+        # Never step past stop; the epsilon keeps an exact stop despite float error
+        count = math.floor((stop - start) / step + 1e-9) + 1
+        return [round(start + i * step, 6) for i in range(count)]
+    return [float(v) for v in text.split(',') if v.strip()]
+
+
+def resolve_signal(name, signal, scale=1.0):
+    """Resolve a signal alias or VarID(s) into a list of (VarID, scale, lo, hi) sources"""
+    if isinstance(signal, str) and signal.upper() in SIGNALS:
+        return [(var_id, s * scale, lo, hi) for var_id, s, lo, hi in SIGNALS[signal.upper()]]
+    ids = signal if isinstance(signal, list) else [signal]
+    try:
+        return [(log_var_id(int(var_id)), scale, None, None) for var_id in ids]
+    except (TypeError, ValueError):
+        raise ValueError(f"Rule '{name}': unknown signal '{signal}' "
+                         f"(aliases: {', '.join(SIGNALS)} or a VarID)") from None
+
+
+def expand_rule(rule):
+    """Expand a rule definition into its grid of concrete settings"""
+    name = rule['name']
+    direction = rule.get('direction', 'above')
+    if direction not in ('above', 'below'):
+        raise ValueError(f"Rule '{name}': direction must be 'above' or 'below'")
+    sources = resolve_signal(name, rule['signal'], float(rule.get('scale', 1.0)))
+    settings = []
+    skipped = 0
+    for on, off, target in itertools.product(parse_values(rule['on']),
+                                             parse_values(rule.get('off')),
+                                             parse_values(rule.get('target'))):
+        if off is None:
+            off = on
+        # Hysteresis band must not overlap the activation threshold
+        if (direction == 'above' and off > on) or (direction == 'below' and off < on):
+            skipped += 1
+            continue
+        settings.append({
+            'rule': name,
+            'direction': direction,
+            'sources': sources,
+            'on': on,
+            'off': off,
+            'target': target,
+        })
+    if skipped:
+        side = 'above' if direction == 'above' else 'below'
+        print(f"⚠ Skipped {skipped} invalid setting(s) for rule '{name}' "
+              f"(off {side} on)")
+    return settings
+
+
+def load_session(path, var_ids):
+    """Load one log file into {VarID: (times, values)} column arrays.
+
+    Only the requested VarIDs are kept. Handles every header variant written by
+    sdLoggerWriteHeader() (optional Sequence and Checksum columns). The file is
+    streamed in a single pass and each matching row goes straight into its
+    VarID's array('d') columns, so memory stays at 16 bytes per kept sample
+    however long the session is.
+
+    Returns None if the file has no Time(ms)/VarID/Value header (e.g. a session
+    cut off before the header was flushed).
+    """
+    with open(path, encoding='utf-8', errors='replace') as f:
+        names = [h.strip() for h in f.readline().split(',')]
+        try:
+            t_col, id_col, v_col = names.index('Time(ms)'), names.index('VarID'), names.index('Value')
+        except ValueError:
+            return None
+        width = len(names)
+
+        columns = {var_id: (array('d'), array('d')) for var_id in var_ids}
+        # sd_logger writes the unsigned form; accept the signed form as well
+        buckets = {}
+        for var_id in var_ids:
+            signed = var_id - (1 << 32) if var_id >= (1 << 31) else var_id
+            buckets[str(var_id)] = buckets[str(signed)] = columns[var_id]
+
+        for line in f:
+            row = line.rstrip('\r\n').split(',')
+            bucket = buckets.get(row[id_col]) if len(row) == width else None
+            if bucket is None:
+                continue
+            try:
+                t, v = float(row[t_col]), float(row[v_col])
+            except ValueError:
+                continue  # Truncated / corrupted line (e.g. power loss mid-write)
+            if v != v:
+                continue  # NaN compares false against every threshold - treat as missing
+            bucket[0].append(t)
+            bucket[1].append(v)
+    return columns
+
+
+def _in_range(times, values, lo, hi):
+    """Drop samples outside [lo, hi] (None = unbounded), like NaN samples"""
+    if lo is None and hi is None:
+        return times, values
+    lo = -math.inf if lo is None else lo
+    hi = math.inf if hi is None else hi
+    if all(lo <= v <= hi for v in values):
+        return times, values
+    keep = [k for k, v in enumerate(values) if lo <= v <= hi]
+    return array('d', map(times.__getitem__, keep)), array('d', map(values.__getitem__, keep))
+
+
+def build_series(columns, sources):
+    """Merge the sources of a signal into one time-ordered (times, values) series"""
+    parts = []
+    for var_id, scale, lo, hi in sources:
+        if columns.get(var_id) and columns[var_id][0]:
+            series = _in_range(*columns[var_id], lo, hi)
+            if series[0]:
+                parts.append((series, scale))
+    if not parts:
+        return array('d'), array('d')
+    if len(parts) == 1:
+        (times, values), scale = parts[0]
+        if scale != 1.0:
+            values = array('d', [v * scale for v in values])
+        return times, values
+    times, values = array('d'), array('d')
+    for (t, v), scale in parts:
+        times.extend(t)
+        values.extend(v if scale == 1.0 else array('d', [x * scale for x in v]))
+    # Each source is already time-ordered, so this sort is a cheap run merge
+    order = sorted(range(len(times)), key=times.__getitem__)
+    return array('d', map(times.__getitem__, order)), array('d', map(values.__getitem__, order))
+
+
+def crossing_edges(values, levels):
+    """Find where the signal crosses every level of a sweep in one pass.
+
+    Returns {level: (rising, falling)} where rising holds the sample indices at
+    which "value >= level" becomes true (index 0 if it starts true) and falling
+    those at which it becomes false. Each sample is placed among the sorted
+    levels with a single bisect, so the cost is one pass over the series plus
+    the number of crossings - not one pass per level of the grid.
+    """
+    levels = sorted(levels)
+    edges = {level: ([], []) for level in levels}
+    if not values:
+        return edges
+    # pos[i] = number of levels <= values[i], i.e. value >= levels[k] <=> pos[i] > k
+    pos = list(map(bisect_right, itertools.repeat(levels, len(values)), values))
+    for k in range(pos[0]):
+        edges[levels[k]][0].append(0)
+    changed = [i for i in range(1, len(pos)) if pos[i] != pos[i - 1]]
+    for i in changed:
+        prev, cur = pos[i - 1], pos[i]
+        if cur > prev:
+            for k in range(prev, cur):
+                edges[levels[k]][0].append(i)
+        else:
+            for k in range(cur, prev):
+                edges[levels[k]][1].append(i)
+    return edges
+
+
+def evaluate(times, setting, edges):
+    """Evaluate one setting on one series, returning activation statistics.
+
+    Activation mirrors the firmware (RPM >= threshold turns the light on, anything
+    below turns it off). With hysteresis, the rule stays active until the signal
+    drops below "off" (or rises above it for "below" rules). Lead time is measured
+    from activation to the first sample reaching "target" within the same activation.
+
+    "below" rules are evaluated on the negated signal, so edges always describe
+    "value >= level" and the walk below only visits crossings, never every sample.
+    """
+    stats = {'activations': 0, 'active_ms': 0.0, 'lead_ms': [], 'missed_targets': 0}
+    if not times:
+        return stats
+    sign = 1.0 if setting['direction'] == 'above' else -1.0
+    starts = edges[sign * setting['on']][0]
+    releases = edges[sign * setting['off']][1]
+    target = edges[sign * setting['target']] if setting['target'] is not None else None
+
+    end_time = times[-1]
+    pos = 0
+    while pos < len(starts):
+        start = starts[pos]
+        k = bisect_right(releases, start)
+        stop = releases[k] if k < len(releases) else None
+        stop_time = times[stop] if stop is not None else end_time
+        stats['activations'] += 1
+        stats['active_ms'] += stop_time - times[start]
+        if target is not None:
+            # Target already reached at activation if its last crossing up is unreleased
+            rising, falling = target
+            r = bisect_right(rising, start)
+            f = bisect_right(falling, start)
+            if r and (not f or rising[r - 1] > falling[f - 1]):
+                stats['lead_ms'].append(0.0)
+            elif r < len(rising) and (stop is None or rising[r] < stop):
+                stats['lead_ms'].append(times[rising[r]] - times[start])
+            else:
+                stats['missed_targets'] += 1
+        if stop is None:
+            break
+        pos = bisect_right(starts, stop, pos)
+    return stats
+
+
+def replay_session(path, settings):
+    """Worker: load one session and evaluate every setting on it.
+
+    Returns None (after printing a warning) for files that cannot be read or
+    are not sd_logger logs, so one bad file does not abort the whole sweep.
+    """
+    var_ids = {source[0] for s in settings for source in s['sources']}
+    try:
+        columns = load_session(path, var_ids)
+    except OSError as e:
+        print(f"⚠ Skipping unreadable log: {path} ({e})")
+        return None
+    if columns is None:
+        print(f"⚠ Skipping log without Time(ms)/VarID/Value header: {path}")
+        return None
+
+    # One crossing pass per (signal, direction) covering every level in the grid
+    groups = {}
+    for setting in settings:
+        key = (tuple(setting['sources']), setting['direction'])
+        sign = 1.0 if setting['direction'] == 'above' else -1.0
+        levels = groups.setdefault(key, set())
+        levels.update(sign * v for v in (setting['on'], setting['off'], setting['target']) if v is not None)
+    prepared = {}
+    for (sources, direction), levels in groups.items():
+        times, values = build_series(columns, list(sources))
+        if direction == 'below':
+            values = array('d', [-v for v in values])
+        prepared[(sources, direction)] = (times, crossing_edges(values, levels))
+
+    results = []
+    for setting in settings:
+        times, edges = prepared[(tuple(setting['sources']), setting['direction'])]
+        stats = evaluate(times, setting, edges)
+        stats['duration_ms'] = (times[-1] - times[0]) if times else 0.0
+        results.append(stats)
+    return results
+
+
+def find_logs(paths):
+    """Expand directories into LOG*.csv files (recursively), keeping explicit files"""
+    files = []
+    for p in map(Path, paths):
+        if p.is_dir():
+            files.extend(sorted(p.rglob(LOG_FILE_PATTERN)))
+        elif p.is_file():
+            files.append(p)
+        else:
+            print(f"⚠ Skipping missing path: {p}")
+    return files
+
+
+def _read_rules_file(rules_file):
+    """Load and shape-check the user rule list from a JSON rules file"""
+    with open(rules_file, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        unknown = set(data) - {'rules'}
+        if unknown:
+            raise ValueError(f"{rules_file}: unknown top-level key(s) {', '.join(sorted(unknown))} "
+                             f"(expected 'rules')")
+        data = data.get('rules', [])
+    if not isinstance(data, list):
+        raise ValueError(f"{rules_file}: expected a list of rules or {{\"rules\": [...]}}")
+    for n, rule in enumerate(data, 1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"{rules_file}: rule #{n} is not an object")
+        if not isinstance(rule.get('name'), str) or not rule['name']:
+            raise ValueError(f"{rules_file}: rule #{n} has no 'name'")
+    return data
+
+
+def load_rules(rules_file, only, overrides):
+    """Build the rule list from defaults, an optional JSON file and --set overrides"""
+    rules = [dict(r) for r in DEFAULT_RULES]
+    if rules_file:
+        by_name = {r['name']: r for r in rules}
+        for rule in _read_rules_file(rules_file):
+            if rule['name'] in by_name:
+                by_name[rule['name']].update(rule)
+            else:
+                rules.append(rule)
+                by_name[rule['name']] = rule
+    for rule in rules:
+        missing = [key for key in ('signal', 'on') if key not in rule]
+        if missing:
+            raise ValueError(f"Rule '{rule['name']}': missing {', '.join(repr(k) for k in missing)}")
+
+    # Overrides are applied before --only so they can name any known rule
+    for override in overrides or []:
+        key, _, value = override.partition('=')
+        name, _, param = key.partition('.')
+        if param not in ('on', 'off', 'target') or not value:
+            raise ValueError(f"Invalid --set '{override}' (expected rule.on|off|target=values)")
+        matched = [r for r in rules if r['name'] == name]
+        if not matched:
+            raise ValueError(f"--set refers to unknown rule '{name}'")
+        for rule in matched:
+            rule[param] = value
+    if only:
+        wanted = {n.strip() for n in only.split(',') if n.strip()}
+        unknown = wanted - {r['name'] for r in rules}
+        if unknown:
+            raise ValueError(f"--only refers to unknown rule(s) {', '.join(sorted(unknown))}")
+        rules = [r for r in rules if r['name'] in wanted]
+    return rules
+
+
+def aggregate(settings, per_session):
+    """Combine per-session statistics into one report row per setting"""
+    rows = []
+    for i, setting in enumerate(settings):
+        activations = sum(r[i]['activations'] for r in per_session)
+        active_ms = sum(r[i]['active_ms'] for r in per_session)
+        logged_ms = sum(r[i]['duration_ms'] for r in per_session)
+        leads = sorted(itertools.chain.from_iterable(r[i]['lead_ms'] for r in per_session))
+        missed = sum(r[i]['missed_targets'] for r in per_session)
+        rows.append({
+            'rule': setting['rule'],
+            'on': setting['on'],
+            'off': setting['off'],
+            'target': '' if setting['target'] is None else setting['target'],
+            'activations': activations,
+            'active_s': round(active_ms / 1000.0, 3),
+            'active_pct': round(100.0 * active_ms / logged_ms, 3) if logged_ms else 0.0,
+            'mean_active_ms': round(active_ms / activations, 1) if activations else 0.0,
+            'per_hour': round(activations * 3600000.0 / logged_ms, 2) if logged_ms else 0.0,
+            'lead_hits': len(leads),
+            'lead_missed': missed,
+            'lead_min_ms': round(leads[0], 1) if leads else '',
+            'lead_median_ms': round(leads[len(leads) // 2], 1) if leads else '',
+            'lead_mean_ms': round(sum(leads) / len(leads), 1) if leads else '',
+        })
+    return rows
+
+
+REPORT_COLUMNS = ['rule', 'on', 'off', 'target', 'activations', 'active_s', 'active_pct',
+                  'mean_active_ms', 'per_hour', 'lead_hits', 'lead_missed',
+                  'lead_min_ms', 'lead_median_ms', 'lead_mean_ms']
+
+
+def print_report(rows, session_count):
+    """Print the sweep results as a table"""
+    print("=" * 80)
+    print(f"RULE REPLAY - {session_count} session(s)")
+    print("=" * 80)
+    header = f"{'rule':14} {'on':>8} {'off':>8} {'target':>8} {'acts':>6} {'active_s':>9} " \
+             f"{'act/h':>7} {'lead_med':>9} {'missed':>6}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        target = '-' if r['target'] == '' else f"{r['target']:g}"
+        print(f"{r['rule']:14} {r['on']:>8g} {r['off']:>8g} {target:>8} "
+              f"{r['activations']:>6} {r['active_s']:>9.1f} {r['per_hour']:>7.1f} "
+              f"{str(r['lead_median_ms']):>9} {r['lead_missed']:>6}")
+    print("=" * 80)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay shift light / AFR rules over SD card logs")
+    parser.add_argument('paths', nargs='+', help="LOG*.csv files or directories containing them")
+    parser.add_argument('--rules', help="JSON file with user-defined rules (or overrides of built-ins)")
+    parser.add_argument('--only', help="Comma-separated rule names to evaluate")
+    parser.add_argument('--set', action='append', dest='overrides', metavar='RULE.PARAM=VALUES',
+                        help="Override a rule parameter, e.g. shift_light.on=3500:6000:250")
+    parser.add_argument('--jobs', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--csv', help="Write the full report to this CSV file")
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        print(f"✗ --jobs must be at least 1 (got {args.jobs})")
+        return 1
+
+    try:
+        rules = load_rules(args.rules, args.only, args.overrides)
+        settings = [s for rule in rules for s in expand_rule(rule)]
+    except (ValueError, KeyError, OSError, json.JSONDecodeError) as e:
+        print(f"✗ Invalid rule configuration: {e}")
+        return 1
+    if not settings:
+        print("✗ No rule settings to evaluate")
+        return 1
+
+    logs = find_logs(args.paths)
+    if not logs:
+        print("✗ No log files found")
+        return 1
+
+    if args.jobs == 1 or len(logs) == 1:
+        per_session = [replay_session(path, settings) for path in logs]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            per_session = list(pool.map(replay_session, logs, itertools.repeat(settings),
+                                        chunksize=max(1, len(logs) // 64)))
+
+    per_session = [r for r in per_session if r is not None]
+    if not per_session:
+        print("✗ No readable log sessions")
+        return 1
+
+    rows = aggregate(settings, per_session)
+    print_report(rows, len(per_session))
+
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"✓ Report written to {args.csv}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())